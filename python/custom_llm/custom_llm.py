@@ -1,101 +1,166 @@
-import base64
+import pybase64
 import os
 import openai
-import json
+import orjson
 from openai import AsyncOpenAI
-import traceback
 import logging
 import logging.config
 import uvicorn
 import aiofiles
 import uuid
-from typing import List, Union, Dict, Optional
-from pydantic import BaseModel, HttpUrl
+import hashlib
+import httpx
+import numpy as np
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from typing import (
+    Annotated,
+    AsyncGenerator,
+    AsyncIterator,
+    List,
+    Tuple,
+    Union,
+    Dict,
+    Optional,
+)
+import msgspec
 
 from fastapi.responses import JSONResponse, StreamingResponse
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 import asyncio
 import random
+import secrets
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Read once at import rather than on every request
+LLM_API_KEY = os.getenv("YOUR_LLM_API_KEY")
+
+# Optional local proxy shared by all workers, reached over a Unix socket with
+# HTTP/2 so the workers multiplex over its upstream connections. Point
+# LLM_BASE_URL at the proxy (e.g. http://llm-proxy/v1) when using it
+LLM_PROXY_UDS = os.getenv("LLM_PROXY_UDS")
+LLM_BASE_URL = os.getenv("LLM_BASE_URL")
+
+# Embedding model for the RAG semantic cache; the cache is off when unset
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not LLM_API_KEY:
+        raise RuntimeError("YOUR_LLM_API_KEY environment variable is not set")
+    if LLM_PROXY_UDS and not LLM_BASE_URL:
+        raise RuntimeError(
+            "LLM_BASE_URL environment variable must point at the proxy when "
+            "LLM_PROXY_UDS is set"
+        )
+
+    # Share one LLM client (and its connection pool) across all requests
+    if LLM_PROXY_UDS:
+        # The proxy speaks cleartext HTTP/2, so skip HTTP/1.1 negotiation
+        http_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                uds=LLM_PROXY_UDS,
+                http1=False,
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+            )
+        )
+    else:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            http2=True,
+        )
+    client = AsyncOpenAI(
+        api_key=LLM_API_KEY, base_url=LLM_BASE_URL, http_client=http_client
+    )
+    app.state.llm_client = client
+    app.state.http_client = http_client
+    try:
+        yield
+    finally:
+        await client.close()
+
+
 app = FastAPI(
     title="Chat Completion API",
     description="API for streaming chat completions with support for text, image, and audio content",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Set your OpenAI API key
-openai.api_key = os.getenv("YOUR_LLM_API_KEY")
+openai.api_key = LLM_API_KEY
 
 
-class TextContent(BaseModel):
-    type: str = "text"
+class TextContent(msgspec.Struct, tag="text", tag_field="type"):
     text: str
 
 
-class ImageContent(BaseModel):
-    type: str = "image"
-    image_url: HttpUrl
+class ImageContent(msgspec.Struct, tag="image", tag_field="type"):
+    image_url: Annotated[str, msgspec.Meta(pattern="^https?://")]
 
 
-class AudioContent(BaseModel):
-    type: str = "input_audio"
+class AudioContent(msgspec.Struct, tag="input_audio", tag_field="type"):
     input_audio: Dict[str, str]
 
 
-class ToolFunction(BaseModel):
+class ToolFunction(msgspec.Struct):
     name: str
     description: Optional[str]
     parameters: Optional[Dict]
     strict: bool = False
 
 
-class Tool(BaseModel):
-    type: str = "function"
+class Tool(msgspec.Struct):
     function: ToolFunction
+    type: str = "function"
 
 
-class ToolChoice(BaseModel):
-    type: str = "function"
+class ToolChoice(msgspec.Struct):
     function: Optional[Dict]
+    type: str = "function"
 
 
-class ResponseFormat(BaseModel):
-    type: str = "json_schema"
+class ResponseFormat(msgspec.Struct):
     json_schema: Optional[Dict[str, str]]
+    type: str = "json_schema"
 
 
-class SystemMessage(BaseModel):
-    role: str = "system"
+# Messages are tagged on "role", so decoding dispatches on it directly
+class SystemMessage(msgspec.Struct, tag="system", tag_field="role"):
     content: Union[str, List[str]]
 
 
-class UserMessage(BaseModel):
-    role: str = "user"
+class UserMessage(msgspec.Struct, tag="user", tag_field="role"):
     content: Union[str, List[Union[TextContent, ImageContent, AudioContent]]]
 
 
-class AssistantMessage(BaseModel):
-    role: str = "assistant"
-    content: Union[str, List[TextContent]] = None
+class AssistantMessage(
+    msgspec.Struct, tag="assistant", tag_field="role", omit_defaults=True
+):
+    content: Union[str, List[TextContent], None] = None
     audio: Optional[Dict[str, str]] = None
     tool_calls: Optional[List[Dict]] = None
 
 
-class ToolMessage(BaseModel):
-    role: str = "tool"
+class ToolMessage(msgspec.Struct, tag="tool", tag_field="role"):
     content: Union[str, List[str]]
     tool_call_id: str
 
 
-class ChatCompletionRequest(BaseModel):
+Message = Union[SystemMessage, UserMessage, AssistantMessage, ToolMessage]
+
+
+class ChatCompletionRequest(msgspec.Struct, kw_only=True):
     context: Optional[Dict] = None
     model: Optional[str] = None
-    messages: List[Union[SystemMessage, UserMessage, AssistantMessage, ToolMessage]]
+    messages: List[Message]
     response_format: Optional[ResponseFormat] = None
-    modalities: List[str] = ["text"]
+    modalities: List[str] = msgspec.field(default_factory=lambda: ["text"])
     audio: Optional[Dict[str, str]] = None
     tools: Optional[List[Tool]] = None
     tool_choice: Optional[Union[str, ToolChoice]] = "auto"
@@ -104,48 +169,327 @@ class ChatCompletionRequest(BaseModel):
     stream_options: Optional[Dict] = None
 
 
-@app.post("/chat/completions")
-async def create_chat_completion(request: ChatCompletionRequest):
+chat_completion_decoder = msgspec.json.Decoder(ChatCompletionRequest)
+
+# FastAPI cannot see the msgspec models, so publish their schema by hand
+(chat_completion_schema,), chat_completion_components = msgspec.json.schema_components(
+    [ChatCompletionRequest], ref_template="#/components/schemas/{name}"
+)
+CHAT_COMPLETION_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": chat_completion_schema}},
+    }
+}
+
+
+def openapi() -> Dict:
+    """
+    Generates the OpenAPI schema, adding the msgspec model definitions
+
+    Returns:
+        Dict: OpenAPI schema
+    """
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(
+            chat_completion_components
+        )
+    return app.openapi_schema
+
+
+app.openapi = openapi
+
+
+async def parse_chat_completion_request(request: Request) -> ChatCompletionRequest:
+    """
+    Decodes and validates the request body in a single pass
+
+    Args:
+        request: Incoming HTTP request
+
+    Returns:
+        ChatCompletionRequest: Decoded request body
+    """
     try:
-        logger.info(f"Received request: {request.model_dump_json()}")
-        client = AsyncOpenAI(api_key=os.getenv("YOUR_LLM_API_KEY"))
-        response = await client.chat.completions.create(
-            model=request.model,
-            messages=request.messages,  # Directly use request messages
-            tool_choice=(
-                request.tool_choice if request.tools and request.tool_choice else None
-            ),
-            tools=request.tools if request.tools else None,
-            modalities=request.modalities,
-            audio=request.audio,
-            response_format=request.response_format,
-            stream=request.stream,
-            stream_options=request.stream_options,
+        return chat_completion_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+# Stop caches and reverse proxies such as nginx from buffering SSE frames
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Sent at the end of every stream
+DONE_FRAME = b"data: [DONE]\n\n"
+
+# SSE frames are coalesced until either limit is reached before being sent
+SSE_COALESCE_MAX_BYTES = 16 * 1024
+SSE_COALESCE_MAX_DELAY = 0.01  # seconds
+# Frames read ahead of the client; bounded so a slow client slows the upstream
+# reads instead of the response piling up in memory. Sized for roughly one
+# full batch of typical ~256 byte chunk frames
+SSE_COALESCE_QUEUE_SIZE = SSE_COALESCE_MAX_BYTES // 256
+
+
+# Queue markers used by coalesce_frames
+FLUSH_MARKER = object()
+END_MARKER = object()
+
+
+async def coalesce_frames(
+    frames: AsyncGenerator[bytes, None],
+    max_bytes: int = SSE_COALESCE_MAX_BYTES,
+    max_delay: float = SSE_COALESCE_MAX_DELAY,
+) -> AsyncIterator[bytes]:
+    """
+    Concatenates consecutive SSE frames so that fewer, larger bodies are sent
+
+    Args:
+        frames: Stream of "data: ...\\n\\n" frames
+        max_bytes: Flush once the buffer reaches this size
+        max_delay: Flush once the oldest buffered frame has waited this long
+
+    Returns:
+        AsyncIterator: Stream of batched frames
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_COALESCE_QUEUE_SIZE)
+
+    # A single reader task feeds the queue for the whole stream, so no task is
+    # created per frame
+    async def read():
+        try:
+            async for frame in frames:
+                await queue.put(frame)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(END_MARKER)
+
+    # The flush timer only has to wake a consumer waiting on an empty queue.
+    # When the queue is full the consumer is not waiting, and it checks the
+    # deadline itself after every frame
+    def wake():
+        if not queue.full():
+            queue.put_nowait(FLUSH_MARKER)
+
+    reader = loop.create_task(read())
+    buf = bytearray()
+    deadline = 0.0
+    timer = None
+    try:
+        while True:
+            item = await queue.get()
+            if item is END_MARKER:
+                break
+            if item is FLUSH_MARKER:
+                timer = None
+                if buf:
+                    yield bytes(buf)
+                    buf.clear()
+                continue
+            if isinstance(item, Exception):
+                # Deliver what arrived before the error, then surface it
+                if buf:
+                    yield bytes(buf)
+                    buf.clear()
+                raise item
+
+            if not buf:
+                deadline = loop.time() + max_delay
+                timer = loop.call_at(deadline, wake)
+            buf += item
+            if len(buf) >= max_bytes or loop.time() >= deadline:
+                timer.cancel()
+                timer = None
+                yield bytes(buf)
+                buf.clear()
+
+        if buf:
+            yield bytes(buf)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        reader.cancel()
+        # The source can only be closed once the reader has stopped using it
+        await asyncio.wait({reader})
+        await frames.aclose()
+
+
+# Completed streams are replayed for identical requests within the TTL
+RESPONSE_CACHE_MAXSIZE = 10_000
+RESPONSE_CACHE_TTL = 300  # seconds
+
+response_cache: TTLCache = TTLCache(
+    maxsize=RESPONSE_CACHE_MAXSIZE, ttl=RESPONSE_CACHE_TTL
+)
+
+
+def response_cache_key(request: ChatCompletionRequest) -> bytes:
+    """
+    Computes a stable hash of a chat completion request
+
+    Args:
+        request: Chat completion request
+
+    Returns:
+        bytes: 16-byte digest of the request body
+    """
+    body = msgspec.json.encode(request, order="sorted")
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+
+# Same limits and retry policy the OpenAI SDK applies to its own requests
+UPSTREAM_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+UPSTREAM_MAX_RETRIES = 2
+UPSTREAM_RETRY_DELAY = 0.5  # seconds, doubled after every attempt
+UPSTREAM_RETRY_MAX_DELAY = 8.0  # seconds
+
+
+async def send_upstream(
+    http_client: httpx.AsyncClient, upstream_request: httpx.Request
+) -> httpx.Response:
+    """
+    Sends a streaming request upstream, retrying transient failures
+
+    Connection errors, 429 and 5xx responses are retried up to
+    UPSTREAM_MAX_RETRIES times with exponential backoff
+
+    Args:
+        http_client: Shared HTTP client
+        upstream_request: Request to send
+
+    Returns:
+        httpx.Response: Response of the last attempt, with its body unread
+    """
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        last_attempt = attempt == UPSTREAM_MAX_RETRIES
+        try:
+            response = await http_client.send(upstream_request, stream=True)
+        except httpx.TransportError:
+            if last_attempt:
+                raise
+        else:
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if not retryable or last_attempt:
+                return response
+            await response.aclose()
+        await asyncio.sleep(
+            min(UPSTREAM_RETRY_DELAY * 2**attempt, UPSTREAM_RETRY_MAX_DELAY)
+        )
+
+
+@app.post("/chat/completions", openapi_extra=CHAT_COMPLETION_OPENAPI)
+async def create_chat_completion(
+    raw_request: Request,
+    request: ChatCompletionRequest = Depends(parse_chat_completion_request),
+):
+    try:
+        logger.info(
+            "Received request: model=%s messages=%d",
+            request.model,
+            len(request.messages),
         )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request body: %s", msgspec.json.encode(request))
+
         if not request.stream:
             raise HTTPException(
                 status_code=400, detail="chat completions require streaming"
             )
 
+        cache_key = response_cache_key(request)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+
+            async def replay():
+                yield cached
+
+            return StreamingResponse(
+                replay(), media_type="text/event-stream", headers=SSE_HEADERS
+            )
+
+        # Nothing is changed on the way through, so forward the upstream SSE
+        # body as is instead of parsing and re-serializing every chunk
+        body = {
+            "model": request.model,
+            # Directly use request messages
+            "messages": request.messages,
+            "tool_choice": (
+                request.tool_choice if request.tools and request.tool_choice else None
+            ),
+            "tools": request.tools if request.tools else None,
+            "modalities": request.modalities,
+            "audio": request.audio,
+            "response_format": request.response_format,
+            "stream": request.stream,
+            "stream_options": request.stream_options,
+        }
+        client = raw_request.app.state.llm_client
+        http_client = raw_request.app.state.http_client
+        upstream_request = http_client.build_request(
+            "POST",
+            str(client.base_url.join("chat/completions")),
+            headers={
+                "Authorization": f"Bearer {LLM_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            content=msgspec.json.encode(
+                {key: value for key, value in body.items() if value is not None}
+            ),
+            timeout=UPSTREAM_TIMEOUT,
+        )
+        # Upstream failures are reported as 502 with an id to correlate with
+        # the log, without passing the provider's status or body through
+        try:
+            response = await send_upstream(http_client, upstream_request)
+        except httpx.TransportError:
+            error_id = uuid.uuid4().hex
+            logger.exception("Upstream request failed id=%s", error_id)
+            raise HTTPException(status_code=502, detail=f"upstream error id={error_id}")
+        if response.is_error:
+            error_id = uuid.uuid4().hex
+            detail = await response.aread()
+            await response.aclose()
+            logger.error(
+                "Upstream request failed id=%s status=%d body=%s",
+                error_id,
+                response.status_code,
+                detail,
+            )
+            raise HTTPException(status_code=502, detail=f"upstream error id={error_id}")
+
         async def generate():
+            frames = []
             try:
-                async for chunk in response:
-                    logger.debug(f"Received chunk: {chunk}")
-                    yield f"data: {json.dumps(chunk.to_dict())}\n\n"
-                yield "data: [DONE]\n\n"
+                async for data in response.aiter_bytes():
+                    logger.debug("Received data: %s", data)
+                    frames.append(data)
+                    yield data
+                # Only complete streams are cached
+                response_cache[cache_key] = b"".join(frames)
             except asyncio.CancelledError:
                 logger.info("Request was cancelled")
                 raise
+            finally:
+                await response.aclose()
 
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        return StreamingResponse(
+            coalesce_frames(generate()),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS,
+        )
     except asyncio.CancelledError:
         logger.info("Request was cancelled")
         raise HTTPException(status_code=499, detail="Request was cancelled")
-    except Exception as e:
-        traceback_str = "".join(traceback.format_tb(e.__traceback__))
-        error_message = f"{str(e)}\n{traceback_str}"
-        logger.error(error_message)
-        raise HTTPException(status_code=500, detail=error_message)
+    except HTTPException:
+        raise
+    except Exception:
+        # Keep details in the log and only return an id to correlate with it
+        error_id = uuid.uuid4().hex
+        logger.exception("Request failed id=%s", error_id)
+        raise HTTPException(status_code=500, detail=f"internal error id={error_id}")
 
 
 async def perform_rag_retrieval(messages: Optional[Dict]) -> str:
@@ -167,7 +511,7 @@ async def perform_rag_retrieval(messages: Optional[Dict]) -> str:
     return "This is relevant content retrieved from the knowledge base."
 
 
-def refact_messages(context: str, messages: Optional[Dict] = None) -> Optional[Dict]:
+def refact_messages(context: str, messages: List[Message]) -> List[Dict]:
     """
     Adjusts the message list by adding the retrieved context to the original message list
 
@@ -176,13 +520,142 @@ def refact_messages(context: str, messages: Optional[Dict] = None) -> Optional[D
         messages: Original message list
 
     Returns:
-        List: Adjusted message list
+        List: Adjusted message list, as plain dicts ready to send to the LLM
+    """
+
+    # Prepend the context as a system message and convert the request messages
+    # in the same pass, so the list is only built once
+    # Adjust this if your model expects the context elsewhere
+    return [{"role": "system", "content": context}, *msgspec.to_builtins(messages)]
+
+
+async def embed_query(
+    client: AsyncOpenAI, messages: List[Message]
+) -> Optional[List[float]]:
+    """
+    Embeds the last user message to look up the semantic response cache
+
+    Args:
+        client: Shared LLM client
+        messages: Original message list
+
+    Returns:
+        List: Embedding of the query, or None to bypass the semantic cache
     """
 
-    # TODO: Implement actual message adjustment logic
-    # This should add the retrieved context to the original message list
+    if not EMBEDDING_MODEL:
+        return None
+
+    query = None
+    for message in reversed(messages):
+        if isinstance(message, UserMessage):
+            if isinstance(message.content, str):
+                query = message.content
+            else:
+                query = "\n".join(
+                    part.text
+                    for part in message.content
+                    if isinstance(part, TextContent)
+                )
+            break
+    if not query:
+        return None
+
+    # The cache is an optimization, so a failed embedding only skips it
+    try:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=query)
+    except Exception:
+        logger.exception("Query embedding failed")
+        return None
+    return response.data[0].embedding
 
-    return messages
+
+class SemanticCache:
+    """
+    Bounded cache of SSE bodies keyed by query embeddings
+
+    Entries are partitioned by a scope digest covering everything in the
+    request except the query itself. A lookup hits when an unexpired entry in
+    the same scope has a cosine similarity with the query that reaches the
+    threshold. The oldest entry is evicted when full.
+    """
+
+    def __init__(self, maxsize: int, threshold: float, ttl: float):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.vectors: Optional[np.ndarray] = None
+        self.scopes = np.zeros(maxsize, dtype="S16")
+        self.expires = np.zeros(maxsize, dtype=np.float64)
+        self.bodies: List[bytes] = []
+        self.next_slot = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, scope: bytes, embedding: List[float]) -> Optional[bytes]:
+        size = len(self.bodies)
+        if not size:
+            return None
+        candidates = (self.scopes[:size] == scope) & (
+            self.expires[:size] > time.monotonic()
+        )
+        if not candidates.any():
+            return None
+        vector = self._normalize(embedding)
+        if vector.shape[0] != self.vectors.shape[1]:
+            # The embedding model changed; its vectors are not comparable
+            return None
+        similarities = np.where(candidates, self.vectors[:size] @ vector, -np.inf)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return self.bodies[best]
+        return None
+
+    def put(self, scope: bytes, embedding: List[float], body: bytes) -> None:
+        vector = self._normalize(embedding)
+        if self.vectors is None:
+            self.vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+        elif vector.shape[0] != self.vectors.shape[1]:
+            return
+        self.vectors[self.next_slot] = vector
+        self.scopes[self.next_slot] = scope
+        self.expires[self.next_slot] = time.monotonic() + self.ttl
+        if self.next_slot < len(self.bodies):
+            self.bodies[self.next_slot] = body
+        else:
+            self.bodies.append(body)
+        self.next_slot = (self.next_slot + 1) % self.maxsize
+
+
+SEMANTIC_CACHE_MAXSIZE = 1024
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = 300  # seconds
+
+semantic_cache = SemanticCache(
+    maxsize=SEMANTIC_CACHE_MAXSIZE,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl=SEMANTIC_CACHE_TTL,
+)
+
+
+def semantic_cache_scope(request: ChatCompletionRequest) -> bytes:
+    """
+    Computes the digest of everything in a request except the query
+
+    Args:
+        request: Chat completion request
+
+    Returns:
+        bytes: 16-byte digest covering the model, tools, response format and
+        all messages before the last one
+    """
+    return response_cache_key(
+        msgspec.structs.replace(request, messages=request.messages[:-1])
+    )
 
 
 waiting_messages = [
@@ -191,76 +664,132 @@ waiting_messages = [
     "Good question, let me find out...",
 ]
 
+WAITING_FRAMES = [
+    b"data: "
+    + orjson.dumps(
+        {
+            "id": "waiting_msg",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": message},
+                    "finish_reason": None,
+                }
+            ],
+        }
+    )
+    + b"\n\n"
+    for message in waiting_messages
+]
+
+# Dedicated generator so picking a waiting message never touches the shared
+# module-level Random instance
+waiting_frame_rng = random.Random()
+
 
-@app.post("/rag/chat/completions")
-async def create_rag_chat_completion(request: ChatCompletionRequest):
+@app.post("/rag/chat/completions", openapi_extra=CHAT_COMPLETION_OPENAPI)
+async def create_rag_chat_completion(
+    raw_request: Request,
+    request: ChatCompletionRequest = Depends(parse_chat_completion_request),
+):
     try:
-        logger.info(f"Received RAG request: {request.model_dump_json()}")
+        logger.info(
+            "Received RAG request: model=%s messages=%d",
+            request.model,
+            len(request.messages),
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request body: %s", msgspec.json.encode(request))
         if not request.stream:
             raise HTTPException(
                 status_code=400, detail="chat completions require streaming"
             )
 
         async def generate():
-            # First send a "please wait" prompt
-            waiting_message = {
-                "id": "waiting_msg",
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "role": "assistant",
-                            "content": random.choice(waiting_messages),
-                        },
-                        "finish_reason": None,
-                    }
-                ],
-            }
-            yield f"data: {json.dumps(waiting_message)}\n\n"
-
-            # Perform RAG retrieval
-            retrieved_context = await perform_rag_retrieval(request.messages)
-
-            # Adjust messages
-            refacted_messages = refact_messages(retrieved_context, request.messages)
-
-            # Request LLM completion
-            client = AsyncOpenAI(api_key=os.getenv("<YOUR_LLM_API_KEY>"))
-            response = await client.chat.completions.create(
-                model=request.model,
-                messages=refacted_messages,
-                tool_choice=(
-                    request.tool_choice
-                    if request.tools and request.tool_choice
-                    else None
-                ),
-                tools=request.tools if request.tools else None,
-                modalities=request.modalities,
-                audio=request.audio,
-                response_format=request.response_format,
-                stream=True,  # Force streaming
-                stream_options=request.stream_options,
+            # Start embedding and retrieval right away so that they overlap
+            # with sending the waiting message
+            client = raw_request.app.state.llm_client
+            embedding_task = asyncio.create_task(embed_query(client, request.messages))
+            retrieval_task = asyncio.create_task(
+                perform_rag_retrieval(request.messages)
             )
-
             try:
-                async for chunk in response:
-                    logger.debug(f"Received RAG chunk: {chunk}")
-                    yield f"data: {json.dumps(chunk.to_dict())}\n\n"
-                yield "data: [DONE]\n\n"
-            except asyncio.CancelledError:
-                logger.info("RAG stream was cancelled")
-                raise
-
-        return StreamingResponse(generate(), media_type="text/event-stream")
+                # First send a "please wait" prompt
+                yield WAITING_FRAMES[waiting_frame_rng.randrange(len(WAITING_FRAMES))]
+
+                # Serve semantically similar queries from the cache
+                query_embedding = await embedding_task
+                if query_embedding is not None:
+                    cache_scope = semantic_cache_scope(request)
+                    cached = semantic_cache.get(cache_scope, query_embedding)
+                    if cached is not None:
+                        yield cached
+                        return
+
+                # Wait for RAG retrieval
+                retrieved_context = await retrieval_task
+
+                # Adjust messages
+                refacted_messages = refact_messages(retrieved_context, request.messages)
+
+                # Request LLM completion
+                response = await client.chat.completions.create(
+                    model=request.model,
+                    messages=refacted_messages,
+                    tool_choice=(
+                        msgspec.to_builtins(request.tool_choice)
+                        if request.tools and request.tool_choice
+                        else None
+                    ),
+                    tools=(
+                        msgspec.to_builtins(request.tools) if request.tools else None
+                    ),
+                    modalities=request.modalities,
+                    audio=request.audio,
+                    response_format=msgspec.to_builtins(request.response_format),
+                    stream=True,  # Force streaming
+                    stream_options=request.stream_options,
+                )
+
+                # Only keep the frames when they can be cached
+                frames = [] if query_embedding is not None else None
+                try:
+                    async for chunk in response:
+                        logger.debug("Received RAG chunk: %s", chunk)
+                        frame = b"data: " + orjson.dumps(chunk.to_dict()) + b"\n\n"
+                        if frames is not None:
+                            frames.append(frame)
+                        yield frame
+                    if frames is not None:
+                        frames.append(DONE_FRAME)
+                        semantic_cache.put(
+                            cache_scope, query_embedding, b"".join(frames)
+                        )
+                    yield DONE_FRAME
+                except asyncio.CancelledError:
+                    logger.info("RAG stream was cancelled")
+                    raise
+            finally:
+                # No-op once the tasks are done
+                embedding_task.cancel()
+                retrieval_task.cancel()
+
+        return StreamingResponse(
+            coalesce_frames(generate()),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS,
+        )
 
     except asyncio.CancelledError:
         logger.info("RAG request was cancelled")
         raise HTTPException(status_code=499, detail="Request was cancelled")
-    except Exception as e:
-        traceback_str = "".join(traceback.format_tb(e.__traceback__))
-        error_message = f"{str(e)}\n{traceback_str}"
-        logger.error(error_message)
-        raise HTTPException(status_code=500, detail=error_message)
+    except HTTPException:
+        raise
+    except Exception:
+        # Keep details in the log and only return an id to correlate with it
+        error_id = uuid.uuid4().hex
+        logger.exception("Request failed id=%s", error_id)
+        raise HTTPException(status_code=500, detail=f"internal error id={error_id}")
 
 
 async def read_text_file(file_path: str) -> str:
@@ -280,11 +809,11 @@ async def read_text_file(file_path: str) -> str:
     return content
 
 
-async def read_pcm_file(
+async def iter_pcm_file(
     file_path: str, sample_rate: int, duration_ms: int
-) -> List[bytes]:
+) -> AsyncIterator[bytes]:
     """
-    Reads a PCM file and returns a list of audio chunks
+    Reads a PCM file and yields it chunk by chunk
 
     Args:
         file_path: Path to the PCM file
@@ -292,21 +821,83 @@ async def read_pcm_file(
         duration_ms: Duration of each audio chunk in milliseconds
 
     Returns:
-        List: List of audio chunks
+        AsyncIterator: Stream of audio chunks
 
     """
 
+    chunk_size = int(sample_rate * 2 * (duration_ms / 1000))
     async with aiofiles.open(file_path, "rb") as file:
-        content = await file.read()
+        while True:
+            chunk = await file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
 
-    chunk_size = int(sample_rate * 2 * (duration_ms / 1000))
-    return [content[i : i + chunk_size] for i in range(0, len(content), chunk_size)]
 
+# Placeholders marking where the per-request ids go in the cached audio frames
+AUDIO_ID_PLACEHOLDER = b"__audio_id__"
+CHUNK_ID_PLACEHOLDER = b"__chunk_id__"
+
+audio_frames_cache: Dict[tuple, List[Tuple[bytes, bytes, bytes]]] = {}
 
-@app.post("/audio/chat/completions")
-async def create_audio_chat_completion(request: ChatCompletionRequest):
+
+async def load_audio_frames(
+    file_path: str, sample_rate: int, duration_ms: int
+) -> List[Tuple[bytes, bytes, bytes]]:
+    """
+    Returns the serialized SSE frames for a PCM file, encoding them on first use
+
+    Args:
+        file_path: Path to the PCM file
+        sample_rate: Sample rate of the audio
+        duration_ms: Duration of each audio chunk in milliseconds
+
+    Returns:
+        List: SSE frames split into the segments before the chunk id, between
+        the chunk id and the audio id, and after the audio id
+
+    """
+
+    key = (file_path, sample_rate, duration_ms)
+    frames = audio_frames_cache.get(key)
+    if frames is None:
+        frames = []
+        async for chunk in iter_pcm_file(file_path, sample_rate, duration_ms):
+            audio_message = {
+                "id": CHUNK_ID_PLACEHOLDER.decode(),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "audio": {
+                                "id": AUDIO_ID_PLACEHOLDER.decode(),
+                                "data": pybase64.b64encode_as_string(chunk),
+                            },
+                        },
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            frame = b"data: " + orjson.dumps(audio_message) + b"\n\n"
+            head, rest = frame.split(CHUNK_ID_PLACEHOLDER)
+            middle, tail = rest.split(AUDIO_ID_PLACEHOLDER)
+            frames.append((head, middle, tail))
+        audio_frames_cache[key] = frames
+    return frames
+
+
+@app.post("/audio/chat/completions", openapi_extra=CHAT_COMPLETION_OPENAPI)
+async def create_audio_chat_completion(
+    request: ChatCompletionRequest = Depends(parse_chat_completion_request),
+):
     try:
-        logger.info(f"Received audio request: {request.model_dump_json()}")
+        logger.info(
+            "Received audio request: model=%s messages=%d",
+            request.model,
+            len(request.messages),
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request body: %s", msgspec.json.encode(request))
 
         if not request.stream:
             raise HTTPException(
@@ -322,14 +913,18 @@ async def create_audio_chat_completion(request: ChatCompletionRequest):
         duration_ms = 40  # 40ms chunks
 
         text_content = await read_text_file(text_file_path)
-        audio_chunks = await read_pcm_file(pcm_file_path, sample_rate, duration_ms)
+        audio_frames = await load_audio_frames(pcm_file_path, sample_rate, duration_ms)
 
         async def generate():
             try:
+                # Chunk ids only need to be unique within this stream, so use
+                # a random per-stream prefix and a counter
+                stream_prefix = secrets.token_hex(12)
+
                 # Send text content
                 audio_id = uuid.uuid4().hex
                 text_message = {
-                    "id": uuid.uuid4().hex,
+                    "id": f"{stream_prefix}{0:08x}",
                     "choices": [
                         {
                             "index": 0,
@@ -343,44 +938,53 @@ async def create_audio_chat_completion(request: ChatCompletionRequest):
                         }
                     ],
                 }
-                yield f"data: {json.dumps(text_message)}\n\n"
-
-                # Send audio chunks
-                for chunk in audio_chunks:
-                    audio_message = {
-                        "id": uuid.uuid4().hex,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {
-                                    "audio": {
-                                        "id": audio_id,
-                                        "data": base64.b64encode(chunk).decode("utf-8"),
-                                    },
-                                },
-                                "finish_reason": None,
-                            }
-                        ],
-                    }
-                    yield f"data: {json.dumps(audio_message)}\n\n"
-
-                yield "data: [DONE]\n\n"
+                batch = [b"data: " + orjson.dumps(text_message) + b"\n\n"]
+                batch_size = len(batch[0])
+
+                # Send audio chunks. The frames are already in memory, so group
+                # them into bodies of about SSE_COALESCE_MAX_BYTES right here
+                audio_id_bytes = audio_id.encode()
+                for i, (head, middle, tail) in enumerate(audio_frames, start=1):
+                    chunk_id = f"{stream_prefix}{i:08x}".encode()
+                    batch += (head, chunk_id, middle, audio_id_bytes, tail)
+                    batch_size += len(head) + len(middle) + len(tail)
+                    if batch_size >= SSE_COALESCE_MAX_BYTES:
+                        yield b"".join(batch)
+                        batch.clear()
+                        batch_size = 0
+
+                batch.append(DONE_FRAME)
+                yield b"".join(batch)
 
             except asyncio.CancelledError:
                 logger.info("Audio stream was cancelled")
                 raise
 
-        return StreamingResponse(generate(), media_type="text/event-stream")
+        return StreamingResponse(
+            generate(), media_type="text/event-stream", headers=SSE_HEADERS
+        )
 
     except asyncio.CancelledError:
         logger.info("Audio request was cancelled")
         raise HTTPException(status_code=499, detail="Request was cancelled")
-    except Exception as e:
-        traceback_str = "".join(traceback.format_tb(e.__traceback__))
-        error_message = f"{str(e)}\n{traceback_str}"
-        logger.error(error_message)
-        raise HTTPException(status_code=500, detail=error_message)
+    except HTTPException:
+        raise
+    except Exception:
+        # Keep details in the log and only return an id to correlate with it
+        error_id = uuid.uuid4().hex
+        logger.exception("Request failed id=%s", error_id)
+        raise HTTPException(status_code=500, detail=f"internal error id={error_id}")
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "custom_llm:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", "4")),
+        timeout_keep_alive=75,
+        backlog=2048,
+        access_log=False,
+    )